@@ -0,0 +1,121 @@
+# On-disk store for the *%cache magic.
+# Each entry is a directory named after the hash of the cell code and the
+# signature of the data in memory before the cell was run.
+
+import os
+import shutil
+import pickle
+import hashlib
+from pathlib import Path
+
+def default_cache_dir():
+    """
+    Use $XDG_CACHE_HOME if set, ~/.cache otherwise
+    """
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+    return os.path.join(base, 'pystata-kernel')
+
+class ResultCache():
+    """
+    Store cell output, returned results and post-cell data, evicting the
+    least recently used entries once the store exceeds size_limit bytes.
+    """
+    output_file = 'output.pickle'
+    returned_file = 'returned.pickle'
+    estimates_file = 'estimates.ster'
+    data_file = 'data.dta'
+
+    def __init__(self, cache_dir=None, size_limit=1024 * 1024**2):
+        self.cache_dir = Path(cache_dir or default_cache_dir()).expanduser()
+        self.size_limit = size_limit
+
+    def key(self, code, signature):
+        """
+        Hash cell code and data signature into an entry name
+        """
+        h = hashlib.sha256()
+        h.update(code.encode('utf-8'))
+        h.update(b'\0')
+        h.update(signature.encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return self.cache_dir / key
+
+    def lookup(self, key):
+        """
+        Return the entry directory if it is complete, None otherwise
+        """
+        path = self.entry_path(key)
+        if not (path / self.output_file).is_file():
+            return None
+        # Mark entry as recently used
+        os.utime(path)
+        return path
+
+    def create(self, key):
+        """
+        Create an empty entry directory, removing any incomplete one
+        """
+        path = self.entry_path(key)
+        if path.exists():
+            shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        return path
+
+    def discard(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def write_output(self, path, stdout, outputs):
+        # Written last, since its presence marks the entry as complete
+        with open(path / self.output_file, 'wb') as f:
+            pickle.dump({'stdout': stdout, 'outputs': outputs}, f)
+
+    def read_output(self, path):
+        with open(path / self.output_file, 'rb') as f:
+            return pickle.load(f)
+
+    def write_returned(self, path, returned):
+        with open(path / self.returned_file, 'wb') as f:
+            pickle.dump(returned, f)
+
+    def read_returned(self, path):
+        with open(path / self.returned_file, 'rb') as f:
+            return pickle.load(f)
+
+    def entries(self):
+        """
+        List of (path, size, last used) for every entry
+        """
+        if not self.cache_dir.is_dir():
+            return []
+        entries = []
+        for path in self.cache_dir.iterdir():
+            if path.is_dir():
+                size = sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+                entries.append((path, size, path.stat().st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the store fits size_limit
+        """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= self.size_limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry, returning the number removed
+        """
+        entries = self.entries()
+        for path, _, _ in entries:
+            shutil.rmtree(path, ignore_errors=True)
+        return len(entries)
@@ -17,7 +17,16 @@ def get_config():
             'graph_format': 'png',
             'echo': 'False',
             'splash': 'True',
-            'missing': '.'
+            'missing': '.',
+            'cache_dir': None,
+            'cache_size': '1024',
+            'parallel_edition': None,
+            'memory_budget': '1024',
+            'memory_action': 'refuse',
+            'results_auto': 'False',
+            'results_history': '20',
+            'processors': 'auto',
+            'max_memory': 'auto'
             }
 
     for cpath in (global_config_path,user_config_path):
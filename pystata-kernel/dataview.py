@@ -0,0 +1,226 @@
+# Column-on-demand access to Stata data from *%%python cells.
+# numpy and pandas are imported when a column is first fetched.
+
+import sys
+import sfi
+import pystata
+from .helpers import str_maxlen
+
+# Range of integers each numeric storage type can hold
+int_ranges = {'byte': (-127, 100), 'int': (-32767, 32740), 'long': (-2147483647, 2147483620)}
+
+def _has_var(hdl, var):
+    try:
+        return hdl.getVarIndex(var) >= 0
+    except ValueError:
+        return False
+
+def _fits(values, vartype):
+    # Whether non-missing values can be stored without loss in a numeric type
+    import numpy as np
+    values = values[~np.isnan(values)]
+    if vartype == 'float':
+        return bool(np.all(values.astype(np.float32) == values))
+    low, high = int_ranges[vartype]
+    return bool(np.all(values == np.round(values))
+                and np.all(values >= low) and np.all(values <= high))
+
+def _object_values(var, values, vartype):
+    # Object arrays, e.g. from pandas nullable columns, hold strings or
+    # numbers with None, NaN or pd.NA for missing values
+    import numpy as np
+    import pandas as pd
+    missing = pd.isna(values)
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == 'empty':
+        kind = 'string' if vartype is not None and vartype.startswith('str') else 'floating'
+    if kind == 'string':
+        return np.where(missing, '', values).astype(str)
+    if kind in ('integer', 'floating', 'mixed-integer-float', 'boolean', 'decimal'):
+        return np.where(missing, np.nan, values).astype(float)
+    raise TypeError(f"Cannot store values of type {kind} in {var}.")
+
+class FrameView():
+    """
+    View of a Stata frame, or of the current dataset if name is None.
+    Columns are fetched as NumPy arrays when first accessed and kept until
+    invalidate() is called. Fetches that would exceed budget bytes, as
+    estimated by estimate_transfer_size, raise MemoryError.
+    """
+
+    def __init__(self, name=None, budget=None):
+        self.name = name
+        self.budget = budget
+        self._columns = {}
+
+    def _handle(self):
+        return sfi.Data if self.name is None else sfi.Frame.connect(self.name)
+
+    def keys(self):
+        hdl = self._handle()
+        return [hdl.getVarName(i) for i in range(hdl.getVarCount())]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, var):
+        return _has_var(self._handle(), var)
+
+    def __len__(self):
+        return self._handle().getObsTotal()
+
+    def __repr__(self):
+        label = 'current dataset' if self.name is None else f"frame {self.name}"
+        return f"<Stata {label}: {len(self)} obs, {len(self.keys())} vars, {len(self._columns)} fetched>"
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held by fetched columns, including the strings they refer to
+        """
+        size = 0
+        for values in self._columns.values():
+            size += values.nbytes
+            if values.dtype.kind == 'O':
+                size += sum(sys.getsizeof(v) for v in values)
+        return size
+
+    def _check_budget(self, hdl, var):
+        # Columns are never downsampled or chunked, whatever memory_action is
+        if self.budget:
+            from .helpers import estimate_transfer_size, budget_error
+            size = estimate_transfer_size(hdl, var, hdl.getObsTotal())
+            if size > self.budget:
+                raise budget_error(size, self.budget)
+
+    def __getitem__(self, var):
+        if var not in self._columns:
+            import numpy as np
+            hdl = self._handle()
+            if not _has_var(hdl, var):
+                raise KeyError(var)
+            self._check_budget(hdl, [var])
+            if hdl.isVarTypeStr(var) or hdl.isVarTypeStrL(var):
+                values = np.array(hdl.getAsDict(var)[var], dtype=object)
+            else:
+                values = np.array(hdl.getAsDict(var, missingval=np.nan)[var], dtype=float)
+            self._columns[var] = values
+        return self._columns[var]
+
+    def __setitem__(self, var, values):
+        self.store(var, values)
+
+    def _recast(self, vartype, var):
+        prefix = '' if self.name is None else f"frame {self.name}: "
+        pystata.stata.run(f"{prefix}recast {vartype} {var}", quietly=True)
+
+    def store(self, var, values):
+        """
+        Store a whole column in one call, creating the variable if needed.
+        An existing variable is promoted to a wider storage type if the
+        values would not fit. An empty dataset is given as many observations
+        as there are values.
+        """
+        import numpy as np
+        values = np.asarray(values)
+        hdl = self._handle()
+
+        nobs = hdl.getObsTotal()
+        if nobs == 0 and hdl.getVarCount() == 0:
+            hdl.addObs(len(values))
+        elif len(values) != nobs:
+            msg = "{0} values given for {1} observations."
+            raise ValueError(msg.format(len(values), nobs))
+
+        exists = _has_var(hdl, var)
+        vartype = hdl.getVarType(var) if exists else None
+
+        if values.dtype.kind == 'O':
+            values = _object_values(var, values, vartype)
+        if values.dtype.kind in 'US':
+            values = values.astype(str)
+            if exists and not vartype.startswith('str'):
+                raise TypeError(f"{var} is numeric; cannot store strings in it.")
+            width = max((len(v.encode('utf-8')) for v in values), default=1)
+            if not exists:
+                if width > str_maxlen:
+                    hdl.addVarStrL(var)
+                else:
+                    hdl.addVarStr(var, max(width, 1))
+            elif vartype != 'strL' and width > int(vartype[3:]):
+                self._recast('strL' if width > str_maxlen else f"str{width}", var)
+            stored = values.tolist()
+        else:
+            try:
+                values = values.astype(float)
+            except (TypeError, ValueError):
+                raise TypeError(f"Cannot store values of type {values.dtype} in {var}.")
+            if exists and vartype.startswith('str'):
+                raise TypeError(f"{var} is a string variable; cannot store numbers in it.")
+            if not exists:
+                hdl.addVarDouble(var)
+            elif vartype != 'double' and not _fits(values, vartype):
+                self._recast('double', var)
+            missing = sfi.Missing.getValue()
+            stored = np.where(np.isnan(values), missing, values).tolist()
+
+        hdl.store(var, None, stored)
+        self._columns[var] = values
+
+    def to_frame(self, var=None):
+        """
+        pandas DataFrame of the given variables, all variables by default
+        """
+        import pandas as pd
+        var = self.keys() if var is None else var
+        var = var.split() if isinstance(var, str) else var
+        hdl = self._handle()
+        # Check the whole transfer before fetching any column
+        self._check_budget(hdl, [v for v in var if v not in self._columns and _has_var(hdl, v)])
+        return pd.DataFrame({v: self[v] for v in var})
+
+    def invalidate(self):
+        """
+        Discard fetched columns
+        """
+        self._columns = {}
+
+
+class StataData(FrameView):
+    """
+    View of the current dataset that also gives access to other frames.
+    """
+
+    def __init__(self, budget=None):
+        super().__init__(None, budget)
+        self._frames = {}
+
+    @property
+    def nbytes(self):
+        return super().nbytes + sum(fr.nbytes for fr in self._frames.values())
+
+    def frames(self):
+        """
+        Names of all frames
+        """
+        return [sfi.Frame.getFrameAt(i) for i in range(sfi.Frame.getFrameCount())]
+
+    def frame(self, name):
+        """
+        View of a named frame
+        """
+        if name not in self._frames:
+            self._frames[name] = FrameView(name, self.budget)
+        return self._frames[name]
+
+    def results(self, kinds=('e', 'r')):
+        """
+        Current e() and r() results as NumPy arrays, see results.collect_results
+        """
+        from .results import collect_results
+        return collect_results(kinds)
+
+    def invalidate(self):
+        super().invalidate()
+        for fr in self._frames.values():
+            fr.invalidate()
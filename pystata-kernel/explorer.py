@@ -0,0 +1,139 @@
+# Variable explorer pushed to the front-end over a comm.
+# On opening, the front-end receives the metadata of every variable; after
+# each cell it only receives what changed.
+
+comm_target = 'pystata-kernel.variables'
+
+def snapshot():
+    """
+    Observation count and (name, type, label) of each variable, from sfi.Data
+    """
+    from sfi import Data
+    nvar = Data.getVarCount()
+    return {'obs': Data.getObsTotal(),
+            'vars': [(Data.getVarName(i), Data.getVarType(i), Data.getVarLabel(i))
+                     for i in range(nvar)]}
+
+def _var_dict(var):
+    return {'name': var[0], 'type': var[1], 'label': var[2]}
+
+def diff(old, new):
+    """
+    Changes between two snapshots, empty if there are none.
+
+    A variable that is dropped and one of the same type and label that is
+    added at the same position are reported as a rename. Since new
+    variables are appended, this is not applied to the last k positions
+    when k variables were added, where dropping variables and generating
+    others would look the same; renaming variables there is reported as
+    drops and additions.
+    """
+    changes = {}
+    if old['obs'] != new['obs']:
+        changes['obs'] = new['obs']
+    if old['vars'] == new['vars']:
+        return changes
+
+    old_vars = {v[0]: v for v in old['vars']}
+    new_vars = {v[0]: v for v in new['vars']}
+    dropped = {name for name in old_vars if name not in new_vars}
+    added = {name for name in new_vars if name not in old_vars}
+
+    renamed = []
+    # Positions before the block of appended variables
+    end = min(len(old['vars']), len(new['vars']) - len(added))
+    for i in range(end):
+        prev, var = old['vars'][i], new['vars'][i]
+        if var[0] in added and prev[0] in dropped and prev[1:] == var[1:]:
+            renamed.append((prev[0], var[0]))
+    for before, after in renamed:
+        dropped.discard(before)
+        added.discard(after)
+
+    changed = [v for name, v in new_vars.items()
+               if name in old_vars and old_vars[name] != v]
+
+    # Lists keep the order of the snapshots
+    if added:
+        changes['added'] = [_var_dict(v) for v in new['vars'] if v[0] in added]
+    if dropped:
+        changes['dropped'] = [v[0] for v in old['vars'] if v[0] in dropped]
+    if renamed:
+        changes['renamed'] = [list(r) for r in renamed]
+    if changed:
+        changes['changed'] = [_var_dict(v) for v in changed]
+
+    # Send the full order only if it is not implied by the changes above
+    renames = dict(renamed)
+    expected = [renames.get(v[0], v[0]) for v in old['vars'] if v[0] not in dropped]
+    expected += [v[0] for v in new['vars'] if v[0] in added]
+    names = [v[0] for v in new['vars']]
+    if expected != names:
+        changes['order'] = names
+
+    return changes
+
+class VariableExplorer():
+    """
+    Keeps the comms opened by front-ends and the last snapshot sent to them
+    """
+
+    def __init__(self):
+        self.comms = []
+        self.pending = []
+        self.state = None
+        # Set once Stata has been launched
+        self.ready = False
+
+    def open(self, comm, msg):
+        """
+        Handler for comm_open messages
+        """
+        self.comms.append(comm)
+        self.pending.append(comm)
+
+        def _recv(msg):
+            # The front-end can ask for a full snapshot to resynchronize
+            if msg['content']['data'].get('request') == 'snapshot':
+                if comm not in self.pending:
+                    self.pending.append(comm)
+                if self.ready:
+                    self.update()
+
+        def _close(msg):
+            if comm in self.comms:
+                self.comms.remove(comm)
+            if comm in self.pending:
+                self.pending.remove(comm)
+
+        comm.on_msg(_recv)
+        comm.on_close(_close)
+        if self.ready:
+            self.update()
+
+    def update(self):
+        """
+        Send changes since the last update, and full snapshots to new comms
+        """
+        if not self.comms or not self.ready:
+            self.state = None
+            return
+
+        state = snapshot()
+        if self.state is not None:
+            changes = diff(self.state, state)
+            if changes:
+                changes['event'] = 'diff'
+                for comm in self.comms:
+                    if comm not in self.pending:
+                        comm.send(changes)
+
+        if self.pending:
+            full = {'event': 'snapshot',
+                    'obs': state['obs'],
+                    'vars': [_var_dict(v) for v in state['vars']]}
+            for comm in self.pending:
+                comm.send(full)
+            self.pending = []
+
+        self.state = state
@@ -1,11 +1,13 @@
 # Helper functions that requires Stata running or works on Stata code
 # but does not depend on the Jupyter kernel.
 
-import pandas as pd
-import numpy as np
 import pystata
 import sfi
 import re
+import math
+
+# Longest str# variable; longer strings are stored as strL
+str_maxlen = 2045
  
 def count():
     """
@@ -197,24 +199,49 @@ def noecho_run(code):
         _run_lines_noecho(co)
 
 
-def better_pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=np.NaN):
+def better_pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=float('nan'),
+                                budget=None, on_budget='refuse'):
     pystata.config.check_initialized()
 
-    return better_dataframe_from_stata(None, var, obs, selectvar, valuelabel, missingval)
+    return better_dataframe_from_stata(None, var, obs, selectvar, valuelabel, missingval,
+                                       budget, on_budget)
 
 
-def better_pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=np.NaN):
+def better_pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=float('nan'),
+                                 budget=None, on_budget='refuse'):
     pystata.config.check_initialized()
 
-    return better_dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval)
+    return better_dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval,
+                                       budget, on_budget)
+
 
+def better_dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval,
+                                budget=None, on_budget='refuse'):
+    """
+    If the estimated size of the transfer exceeds budget bytes, either raise
+    MemoryError ('refuse'), fetch evenly spaced observations ('downsample')
+    or return an iterator of DataFrames that each fit the budget ('chunk').
+    """
+    import pandas as pd
 
-def better_dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval):
     hdl = sfi.Data if stfr is None else sfi.Frame.connect(stfr)
 
     if hdl.getObsTotal() <= 0:
         return None
 
+    if budget and not isinstance(obs, int):
+        obs_range = range(hdl.getObsTotal()) if obs is None else obs
+        size = estimate_transfer_size(hdl, var, len(obs_range))
+        if size > budget:
+            if on_budget == 'downsample':
+                obs = obs_range[::math.ceil(size / budget)]
+            elif on_budget == 'chunk':
+                n = max(1, int(len(obs_range) * budget // size))
+                chunks = (obs_range[i:i+n] for i in range(0, len(obs_range), n))
+                return _iter_dataframes(hdl, var, chunks, selectvar, valuelabel, missingval)
+            else:
+                raise budget_error(size, budget)
+
     pystata.stata.run("""tempvar indexvar
                          generate `indexvar' = _n""", quietly=True)
     idx_var = sfi.Macro.getLocal('indexvar')
@@ -232,3 +259,288 @@ def better_dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingva
     return pd.DataFrame(data=data, index=idx).convert_dtypes()
 
 
+def _iter_dataframes(hdl, var, chunks, selectvar, valuelabel, missingval):
+    # The index is computed here rather than from a temporary variable,
+    # since the iterator may never be exhausted
+    import pandas as pd
+
+    for chunk in chunks:
+        data = hdl.getAsDict(var, chunk, selectvar, valuelabel, missingval)
+        obs = list(chunk)
+        if selectvar is not None:
+            selected = hdl.getAsDict(selectvar, chunk)[selectvar]
+            obs = [o for o, s in zip(obs, selected) if s != 0]
+        idx = pd.array([o + 1 for o in obs], dtype='Int64')
+        yield pd.DataFrame(data=data, index=idx).convert_dtypes()
+
+
+# Bytes per observation of numeric Stata storage types
+storage_widths = {'byte': 1, 'int': 2, 'long': 4, 'float': 4, 'double': 8}
+# Assumed average length of strL values, which can be of any size
+strl_width = 128
+
+def storage_width(vartype):
+    """
+    Bytes per observation used by Stata for a storage type
+    """
+    if vartype == 'strL':
+        return strl_width
+    if vartype.startswith('str'):
+        return int(vartype[3:])
+    return storage_widths[vartype]
+
+def _var_indices(hdl, var):
+    if var is None:
+        return range(hdl.getVarCount())
+    if isinstance(var, (str, int)):
+        var = var.split() if isinstance(var, str) else [var]
+    return [v if isinstance(v, int) else hdl.getVarIndex(v) for v in var]
+
+def dataset_size(hdl=sfi.Data):
+    """
+    Size of a dataset in memory in bytes: width x obs
+    """
+    width = sum(storage_width(hdl.getVarType(i)) for i in range(hdl.getVarCount()))
+    return width * hdl.getObsTotal()
+
+def estimate_transfer_size(hdl, var, nobs):
+    """
+    Rough peak size in bytes of fetching nobs observations of var into a
+    DataFrame: one Python object per value in the intermediate dict of lists,
+    plus the DataFrame itself.
+    """
+    size = 0
+    for i in _var_indices(hdl, var):
+        vartype = hdl.getVarType(i)
+        if vartype.startswith('str'):
+            # str object, list pointer, DataFrame copy
+            size += 2 * (49 + storage_width(vartype)) + 16
+        else:
+            # float object, list pointer, DataFrame value
+            size += 24 + 8 + 8
+    return size * nobs
+
+def budget_error(size, budget):
+    """
+    MemoryError for a transfer of size bytes exceeding budget bytes
+    """
+    msg = "Transfer would use about {0} MB, exceeding the budget of {1} MB."
+    return MemoryError(msg.format(round(size / 1024**2), round(budget / 1024**2)))
+
+def get_returned(kind='r'):
+    """
+    Collect the scalars, macros and matrices currently stored in r() or e()
+    """
+    return get_all_returned((kind,))[kind]
+
+
+def get_all_returned(kinds=('e', 'r')):
+    """
+    Collect results of several kinds, listing their names in a single Stata call
+    """
+    cmd = []
+    for kind in kinds:
+        for t in ('scalars', 'macros', 'matrices'):
+            cmd.append(f"local __pk_{kind}{t} : {kind}({t})")
+    pystata.stata.run("\n".join(cmd), quietly=True)
+
+    all_results = {}
+    for kind in kinds:
+        results = {'scalars': {}, 'macros': {}, 'matrices': {}}
+        for name in sfi.Macro.getLocal(f'__pk_{kind}scalars').split():
+            results['scalars'][name] = sfi.Scalar.getValue(f"{kind}({name})")
+        for name in sfi.Macro.getLocal(f'__pk_{kind}macros').split():
+            results['macros'][name] = sfi.Macro.getGlobal(f"{kind}({name})")
+        for name in sfi.Macro.getLocal(f'__pk_{kind}matrices').split():
+            mat = f"{kind}({name})"
+            results['matrices'][name] = (sfi.Matrix.get(mat),
+                                         sfi.Matrix.getRowNames(mat),
+                                         sfi.Matrix.getColNames(mat))
+        all_results[kind] = results
+    return all_results
+
+
+def post_returned(results):
+    """
+    Post results collected by get_returned('r') back into r()
+    """
+    _program_name = "temp_pystata_kernel_rreturn"
+    lines = [f"program {_program_name}, rclass"]
+    scalars = []
+
+    for i, (name, value) in enumerate(results['scalars'].items()):
+        tmp = f"__pk_rs{i}"
+        sfi.Scalar.setValue(tmp, value)
+        scalars.append(tmp)
+        lines.append(f"return scalar {name} = {tmp}")
+    for i, (name, value) in enumerate(results['macros'].items()):
+        tmp = f"__pk_rm{i}"
+        sfi.Macro.setGlobal(tmp, value)
+        lines.append(f"return local {name} `\"${{{tmp}}}\"'")
+    for i, (name, (values, rownames, colnames)) in enumerate(results['matrices'].items()):
+        tmp = f"__pk_rx{i}"
+        sfi.Matrix.create(tmp, len(rownames), len(colnames), 0)
+        sfi.Matrix.store(tmp, values)
+        sfi.Matrix.setRowNames(tmp, rownames)
+        sfi.Matrix.setColNames(tmp, colnames)
+        lines.append(f"return matrix {name} = {tmp}")
+    lines.append("end")
+
+    pystata.stata.run(f"capture program drop {_program_name}", quietly=True)
+    pystata.stata.run("\n".join(lines), quietly=True)
+    pystata.stata.run(_program_name, quietly=True)
+    pystata.stata.run(f"program drop {_program_name}", quietly=True)
+    pystata.stata.run("macro drop __pk_rm*", quietly=True)
+    for tmp in scalars:
+        pystata.stata.run(f"scalar drop {tmp}", quietly=True)
+
+
+def get_session_state():
+    """
+    Globals, scalars and matrices defined in the session, and the working
+    directory, so that they can be recreated in another Stata instance
+    """
+    pystata.stata.run("""local __pk_globals : all globals
+                         local __pk_scalars : all numeric scalars
+                         local __pk_strscalars : all string scalars
+                         local __pk_matrices : all matrices
+                         local __pk_pwd `"`c(pwd)'"'""", quietly=True)
+
+    state = {'globals': {}, 'scalars': {}, 'strscalars': {}, 'matrices': {},
+             'pwd': sfi.Macro.getLocal('__pk_pwd')}
+    for name in sfi.Macro.getLocal('__pk_globals').split():
+        # S_ globals are set by Stata itself
+        if not name.startswith('S_'):
+            state['globals'][name] = sfi.Macro.getGlobal(name)
+    for name in sfi.Macro.getLocal('__pk_scalars').split():
+        state['scalars'][name] = sfi.Scalar.getValue(name)
+    for name in sfi.Macro.getLocal('__pk_strscalars').split():
+        state['strscalars'][name] = sfi.Scalar.getString(name)
+    for name in sfi.Macro.getLocal('__pk_matrices').split():
+        state['matrices'][name] = (sfi.Matrix.get(name),
+                                   sfi.Matrix.getRowNames(name),
+                                   sfi.Matrix.getColNames(name))
+    return state
+
+
+def set_session_state(state):
+    """
+    Recreate the state collected by get_session_state()
+    """
+    for name, value in state['globals'].items():
+        sfi.Macro.setGlobal(name, value)
+    for name, value in state['scalars'].items():
+        sfi.Scalar.setValue(name, value)
+    for name, value in state['strscalars'].items():
+        sfi.Scalar.setString(name, value)
+    for name, (values, rownames, colnames) in state['matrices'].items():
+        sfi.Matrix.create(name, len(rownames), len(colnames), 0)
+        sfi.Matrix.store(name, values)
+        sfi.Matrix.setRowNames(name, rownames)
+        sfi.Matrix.setColNames(name, colnames)
+    if state['pwd']:
+        pystata.stata.run(f'cd `"{state["pwd"]}"\'', quietly=True)
+
+
+def save_data_copy(path):
+    """
+    Save the data in the current frame through a temporary copy, so that
+    c(filename) and c(changed) of the current frame are left untouched
+    """
+    pystata.stata.run(f"""local __pk_cwf = c(frame)
+                          capture frame drop __pk_copy
+                          frame copy `__pk_cwf' __pk_copy
+                          capture frame __pk_copy: save `"{path}"', replace
+                          local __pk_rc = _rc
+                          frame drop __pk_copy
+                          error `__pk_rc'""", quietly=True)
+
+
+def load_data_copy(path):
+    """
+    Replace the data in the current frame with a saved file through a
+    temporary frame, keeping the current c(filename).
+    Returns False if the filename could not be kept.
+    """
+    pystata.stata.run(f"""local __pk_cwf = c(frame)
+                          local __pk_filename `"`c(filename)'"'
+                          capture frame drop __pk_copy
+                          frame create __pk_copy
+                          frame __pk_copy: use `"{path}"'
+                          frame copy __pk_copy `__pk_cwf', replace
+                          frame drop __pk_copy
+                          global S_FN `"`__pk_filename'"'
+                          local __pk_after `"`c(filename)'"'""", quietly=True)
+    return sfi.Macro.getLocal('__pk_filename') == sfi.Macro.getLocal('__pk_after')
+
+
+def estimation_fingerprint():
+    """
+    Identifies the active estimation results, None if there are none
+    """
+    cmdline = sfi.Macro.getGlobal('e(cmdline)')
+    if not cmdline:
+        return None
+    try:
+        b = sfi.Matrix.get('e(b)')
+    except Exception:
+        b = None
+    return (cmdline, repr(b))
+
+
+def data_signature():
+    """
+    Signature of the data in memory, of the active estimation results and
+    of the session state from get_session_state(), obtained without
+    disturbing r(). Local macros are not included.
+    """
+    pystata.stata.run("""_return hold __pk_hold
+                         capture quietly datasignature
+                         local __pk_signature `r(datasignature)'
+                         _return restore __pk_hold""", quietly=True)
+    signature = [sfi.Macro.getLocal('__pk_signature')]
+
+    # Postestimation commands such as margins depend on e() as well
+    fingerprint = estimation_fingerprint()
+    if fingerprint is not None:
+        signature += fingerprint
+
+    # Cells often refer to globals, scalars and matrices set earlier
+    signature.append(get_session_state())
+    return repr(signature)
+
+def set_resource_limits(env):
+    """
+    Set Stata's processors and max_memory from the processors and max_memory
+    settings, where 'auto' uses the CPUs and memory available to this process.
+    Returns a summary of the resulting settings.
+    """
+    from .utils import cpu_limit, memory_limit
+
+    cmd = []
+    if env['edition'].lower() == 'mp':
+        if env['processors'] == 'auto':
+            cmd.append(f"capture set processors {cpu_limit()}")
+        elif env['processors'] != 'default':
+            cmd.append(f"set processors {int(env['processors'])}")
+
+    if env['max_memory'] == 'auto':
+        limit = memory_limit()
+        if limit is not None:
+            # Leave room for the kernel's own Python process
+            cmd.append(f"capture set max_memory {int(limit * 0.8) // 1024**2}m")
+    elif env['max_memory'] != 'default':
+        cmd.append(f"set max_memory {env['max_memory']}")
+
+    cmd.append("local __pk_processors = c(processors)")
+    cmd.append("local __pk_max_memory = c(max_memory)")
+    pystata.stata.run("\n".join(cmd), quietly=True)
+
+    # c(max_memory) is missing if unlimited
+    try:
+        max_memory = f"{float(sfi.Macro.getLocal('__pk_max_memory')) / 1024**2:.0f}m"
+    except ValueError:
+        max_memory = 'unlimited'
+    return "Stata processors: {0} ({1}), max_memory: {2} ({3})".format(
+        sfi.Macro.getLocal('__pk_processors'), env['processors'],
+        max_memory, env['max_memory'])
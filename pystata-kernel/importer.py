@@ -0,0 +1,273 @@
+# Chunked import of CSV, Parquet and Arrow files for the *%import magic.
+# Files are read with pyarrow's multithreaded readers, and each batch of rows
+# is stored into Stata with one sfi store call per column, so that memory
+# use is bounded by the batch size rather than the file size.
+
+import os
+import re
+import pystata
+import sfi
+from .helpers import str_maxlen
+
+# Names Stata does not allow for variables
+reserved_names = {'_all', '_b', 'byte', '_coef', '_cons', 'double', 'float', 'if',
+                  'in', 'int', 'long', '_n', '_N', '_pi', '_pred', '_rc', '_se',
+                  '_skip', 'strL', 'using', 'with'}
+reserved_regex = re.compile(r'\Astr([1-9]\d{0,3})\Z')
+# CSV conversion errors name the column that failed
+csv_column_regex = re.compile(r'CSV column #(\d+)')
+# Offsets between the Unix epoch and Stata's 01jan1960
+epoch_days = 3653
+epoch_ms = epoch_days * 86400000
+
+def file_format(path):
+    """
+    Guess file format from extension
+    """
+    name = path.lower()
+    if name.endswith('.gz') or name.endswith('.bz2'):
+        name = os.path.splitext(name)[0]
+    ext = os.path.splitext(name)[1]
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+    if ext in ('.arrow', '.feather', '.ipc'):
+        return 'arrow'
+    return 'csv'
+
+def read_batches(path, fmt, chunksize, column_types=None):
+    """
+    Return the schema and an iterator over record batches of a file.
+    column_types maps CSV column names to Arrow types, overriding inference.
+    """
+    import pyarrow as pa
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        return pf.schema_arrow, pf.iter_batches(batch_size=chunksize, use_threads=True)
+
+    if fmt == 'arrow':
+        try:
+            reader = pa.ipc.open_file(path)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            reader = pa.ipc.open_stream(path)
+            batches = iter(reader)
+        return reader.schema, _rebatch(batches, chunksize)
+
+    import pyarrow.csv as csv
+    delimiter = '\t' if re.search(r'\.tsv(\.|$)|\.tab(\.|$)', path.lower()) else ','
+    # Arrow reads one block at a time, parsing it across threads
+    reader = csv.open_csv(path,
+                          read_options=csv.ReadOptions(use_threads=True,
+                                                       block_size=64 * 1024**2),
+                          parse_options=csv.ParseOptions(delimiter=delimiter),
+                          convert_options=csv.ConvertOptions(column_types=column_types or {}))
+    return reader.schema, _rebatch(reader, chunksize)
+
+def _rebatch(batches, chunksize):
+    # Split batches larger than chunksize rows
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunksize):
+            yield batch.slice(start, chunksize)
+
+def stata_type(t):
+    """
+    Stata storage type for an Arrow type, None if unsupported.
+    Integer types are mapped to the smallest Stata type that holds their
+    whole range, since Stata reserves the top of each range for missing values.
+    """
+    import pyarrow as pa
+
+    if pa.types.is_dictionary(t):
+        return 'long'
+    if pa.types.is_boolean(t):
+        return 'byte'
+    if pa.types.is_int8(t) or pa.types.is_uint8(t):
+        return 'int'
+    if pa.types.is_int16(t) or pa.types.is_uint16(t):
+        return 'long'
+    if pa.types.is_integer(t):
+        return 'double'
+    if pa.types.is_float16(t) or pa.types.is_float32(t):
+        return 'float'
+    if pa.types.is_floating(t) or pa.types.is_decimal(t):
+        return 'double'
+    if pa.types.is_date(t):
+        return 'long'
+    if pa.types.is_timestamp(t):
+        return 'double'
+    if pa.types.is_string(t) or pa.types.is_large_string(t):
+        return 'str'
+    return None
+
+def stata_name(name, used):
+    """
+    Valid and unique Stata variable name
+    """
+    new = re.sub(r'[^A-Za-z0-9_]', '_', name.strip())
+    if not new or new[0].isdigit() or new in reserved_names or reserved_regex.match(new):
+        new = '_' + new
+    new = new[:32]
+    i = 1
+    while new in used:
+        suffix = str(i)
+        new = new[:32 - len(suffix)] + suffix
+        i += 1
+    used.add(new)
+    return new
+
+class Column():
+    """
+    Converts batches of an Arrow column into values for sfi stores
+    """
+
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+        self.type = stata_type(field.type)
+        self.width = 1
+        # Value label codes of dictionary columns
+        self.codes = {}
+
+    def add(self, hdl):
+        if self.type == 'str':
+            hdl.addVarStr(self.name, 1)
+        else:
+            getattr(hdl, 'addVar' + self.type.capitalize())(self.name)
+
+    def values(self, arr, missing):
+        """
+        Convert an Arrow array. Returns the values and, for strings that do
+        not fit the current width, the new storage type.
+        """
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        t = arr.type
+        recast = None
+        if pa.types.is_dictionary(t):
+            labels = arr.dictionary.cast(pa.string()).to_pylist()
+            for label in labels:
+                if label not in self.codes:
+                    self.codes[label] = len(self.codes) + 1
+            mapping = np.array([self.codes[label] for label in labels] or [0], dtype=float)
+            indices = arr.indices.to_numpy(zero_copy_only=False)
+            values = np.where(arr.is_null().to_numpy(zero_copy_only=False),
+                              np.nan, mapping[np.nan_to_num(indices).astype(int)])
+        elif self.type == 'str':
+            if len(arr) > 0 and arr.null_count < len(arr):
+                width = pc.max(pc.binary_length(arr)).as_py()
+                if width > self.width:
+                    if self.width <= str_maxlen:
+                        recast = 'strL' if width > str_maxlen else f'str{width}'
+                    self.width = width
+            return arr.fill_null('').to_pylist(), recast
+        elif pa.types.is_date(t):
+            values = arr.cast(pa.date32()).cast(pa.int32()).to_numpy(zero_copy_only=False) + epoch_days
+        elif pa.types.is_timestamp(t):
+            # Truncate sub-millisecond precision, which Stata cannot hold
+            values = arr.cast(pa.timestamp('ms', tz=t.tz), safe=False).cast(pa.int64()).to_numpy(zero_copy_only=False) + epoch_ms
+        elif pa.types.is_boolean(t):
+            values = arr.cast(pa.int8()).to_numpy(zero_copy_only=False)
+        else:
+            values = arr.cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+        values = np.asarray(values, dtype=float)
+        return np.where(np.isnan(values), missing, values).tolist(), recast
+
+    def setup_commands(self):
+        """
+        Stata commands for formats, labels and value labels after the import
+        """
+        import pyarrow as pa
+
+        cmd = []
+        t = self.field.type
+        if pa.types.is_date(t):
+            cmd.append(f"format {self.name} %td")
+        elif pa.types.is_timestamp(t):
+            cmd.append(f"format {self.name} %tc")
+        if self.name != self.field.name:
+            cmd.append(f"label variable {self.name} `\"{self.field.name}\"'")
+        if self.codes:
+            for label, code in self.codes.items():
+                cmd.append(f"label define {self.name} {code} `\"{label}\"', add")
+            cmd.append(f"label values {self.name} {self.name}")
+        return cmd
+
+def import_file(path, frame=None, chunksize=100000, column_types=None):
+    """
+    Import a file into the current dataset or an existing, empty frame.
+
+    The CSV reader infers column types from the first block only. If a later
+    block cannot be converted, the failing column is read as strings and the
+    import restarts. On any other error the dataset or frame is cleared.
+
+    Returns (observations, variables, skipped column names, CSV columns read
+    as strings after a conversion error).
+    """
+    import pyarrow as pa
+
+    fmt = file_format(path)
+    column_types = dict(column_types or {})
+    as_string = []
+    clear = "clear" if frame is None else f"frame {frame}: clear"
+    while True:
+        schema, batches = read_batches(path, fmt, chunksize, column_types)
+        try:
+            return _import_batches(schema, batches, frame) + (as_string,)
+        except BaseException as e:
+            pystata.stata.run(clear, quietly=True)
+            match = csv_column_regex.search(str(e))
+            if fmt != 'csv' or not isinstance(e, pa.ArrowInvalid) or not match:
+                raise
+            name = schema.names[int(match.group(1))]
+            if name in column_types:
+                raise
+            column_types[name] = pa.string()
+            as_string.append(name)
+
+def _import_batches(schema, batches, frame):
+    hdl = sfi.Data if frame is None else sfi.Frame.connect(frame)
+    prefix = '' if frame is None else f"frame {frame}: "
+
+    used = set()
+    columns = []
+    skipped = []
+    for field in schema:
+        col = Column(stata_name(field.name, used), field)
+        if col.type is None:
+            skipped.append(field.name)
+        else:
+            col.add(hdl)
+        columns.append(col)
+
+    missing = sfi.Missing.getValue()
+    nobs = 0
+    for batch in batches:
+        n = batch.num_rows
+        if n == 0:
+            continue
+        hdl.addObs(n)
+        obs = range(nobs, nobs + n)
+        for col, arr in zip(columns, batch.columns):
+            if col.type is None:
+                continue
+            values, recast = col.values(arr, missing)
+            if recast:
+                pystata.stata.run(f"{prefix}recast {recast} {col.name}", quietly=True)
+            hdl.store(col.name, obs, values)
+        nobs += n
+
+    cmd = []
+    for col in columns:
+        if col.type is not None:
+            cmd += col.setup_commands()
+    if cmd:
+        if frame is not None:
+            cmd = [f"frame {frame} {{"] + cmd + ["}"]
+        pystata.stata.run("\n".join(cmd), quietly=True)
+
+    return nobs, len(columns) - len(skipped), skipped
@@ -5,7 +5,6 @@ import sys
 
 from jupyter_client.kernelspec import KernelSpecManager
 from IPython.utils.tempdir import TemporaryDirectory
-from pkg_resources import resource_filename
 from shutil import copyfile
 from pathlib import Path
 from textwrap import dedent
@@ -25,7 +24,7 @@ def install_my_kernel_spec(user=True, prefix=None):
             json.dump(kernel_json, f, sort_keys=True)
 
         # Copy logo to tempdir to be installed with kernelspec
-        logo_path = resource_filename('pystata-kernel', 'logo-64x64.png')
+        logo_path = os.path.join(os.path.dirname(__file__), 'logo-64x64.png')
         copyfile(logo_path, os.path.join(td, 'logo-64x64.png'))
 
         print('Installing Jupyter kernel spec')
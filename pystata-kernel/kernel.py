@@ -8,8 +8,8 @@ Requires Stata 17 and stata_setup.
 from ipykernel.ipkernel import IPythonKernel
 from .config import get_config
 import os
+import re
 import sys
-from packaging import version
 
 class PyStataKernel(IPythonKernel):
     implementation = 'pystata-kernel'
@@ -33,6 +33,14 @@ class PyStataKernel(IPythonKernel):
         self.quietly = False
         self.magic_handler = None
         self.env = None
+        self.data_view = None
+        self.python_result = None
+        self.results_history = None
+
+        # Front-ends may open the variable explorer before Stata is launched
+        from .explorer import VariableExplorer, comm_target
+        self.variable_explorer = VariableExplorer()
+        self.comm_manager.register_target(comm_target, self.variable_explorer.open)
 
     def launch_stata(self, path, edition, splash=True):
         """
@@ -46,12 +54,34 @@ class PyStataKernel(IPythonKernel):
 
         sys.path.append(os.path.join(path, 'utilities'))
         import pystata
-        if version.parse(pystata.__version__) >= version.parse("0.1.1"):
+        if _version_tuple(pystata.__version__) >= (0, 1, 1):
             # Splash message control is a new feature of pystata-0.1.1
             pystata.config.init(edition,splash=splash)
         else:
             pystata.config.init(edition)
 
+    def apply_resource_limits(self, env):
+        """
+        Match Stata's processors and max_memory settings to the CPUs and
+        memory available to the kernel, which may be less than the host's
+        inside a container or a job allocation.
+        """
+        from .helpers import set_resource_limits
+        # Shown in the terminal running Jupyter, unlike info-level log messages
+        print(set_resource_limits(env), file=sys.__stderr__, flush=True)
+
+    def run_stata(self, code):
+        """
+        Run Stata code using the echo and quietly settings of the current cell.
+        """
+        # Supress echo?
+        if self.noecho and not self.quietly:
+            from .helpers import noecho_run
+            noecho_run(code)
+        else:
+            from pystata.stata import run
+            run(code, quietly=self.quietly, inline=True, echo=self.echo)
+
     def do_execute(self, code, silent, store_history=True, user_expressions=None,
                    allow_stdin=False):
 
@@ -67,6 +97,8 @@ class PyStataKernel(IPythonKernel):
             if env['echo'] not in ('True','False','None'):
                 raise OSError("'" + env['echo'] + "' is not an acceptable value for 'echo'.")
 
+            self.apply_resource_limits(env)
+
             # Set graph format
             if env['graph_format'] == 'pystata':
                 pass
@@ -78,7 +110,18 @@ class PyStataKernel(IPythonKernel):
             from .magics import StataMagics
             self.magic_handler = StataMagics()
 
+            # View of Stata data for *%%python cells
+            from .dataview import StataData
+            self.data_view = StataData(float(env['memory_budget']) * 1024**2)
+            self.shell.user_ns['stata_data'] = self.data_view
+
+            # Estimation results captured after each cell if results_auto is on
+            from .results import ResultsHistory
+            self.results_history = ResultsHistory(int(env['results_history']))
+            self.shell.user_ns['stata_results'] = self.results_history
+
             self.stata_ready = True
+            self.variable_explorer.ready = True
 
         # Read settings from env dict every time so that these can be modified by magics 
         # for each cell.
@@ -92,6 +135,7 @@ class PyStataKernel(IPythonKernel):
             self.noecho = False
             self.echo = False
         self.quietly = False
+        self.python_result = None
         
         try:
             # Process magics
@@ -99,17 +143,16 @@ class PyStataKernel(IPythonKernel):
             
             # Execute Stata code after magics
             if code != '':
-                # Supress echo?
-                if self.noecho and not self.quietly:
-                    from .helpers import noecho_run
-                    noecho_run(code)
-                else:
-                    from pystata.stata import run
-                    run(code, quietly=self.quietly, inline=True, echo=self.echo)
+                self.run_stata(code)
 
+            if self.env['results_auto'] == 'True' and self.python_result is None:
+                self.results_history.update()
 
             self.shell.execution_count += 1
 
+            if self.python_result is not None and not self.python_result.success:
+                return _handle_python_error(self.python_result, self.execution_count)
+
             return {'status': 'ok',
                 'execution_count': self.execution_count,
                 'payload': [],
@@ -119,6 +162,21 @@ class PyStataKernel(IPythonKernel):
         except SystemError as err:
             return _handle_stata_error(err, silent, self.execution_count)
 
+        finally:
+            # Any cell other than Python may have modified the data
+            if self.python_result is None and self.data_view is not None:
+                self.data_view.invalidate()
+
+            if self.stata_ready:
+                try:
+                    self.variable_explorer.update()
+                except Exception as e:
+                    self.log.warning("Failed to update variable explorer: %s", e)
+
+def _version_tuple(text):
+    # Numeric release components, e.g. '0.1.1' -> (0, 1, 1)
+    return tuple(int(p) for p in re.findall(r'\d+', text.split('+')[0])[:3])
+
 def print_red(text):
     print(f"\x1b[31m{text}\x1b[0m")
 
@@ -140,4 +198,15 @@ def _handle_stata_error(err, silent, execution_count):
         'status': "error",
         'execution_count': execution_count,
     })
-    return reply_content
\ No newline at end of file
+    return reply_content
+
+def _handle_python_error(result, execution_count):
+    # The traceback has already been displayed by the IPython shell
+    err = result.error_in_exec or result.error_before_exec
+    return {
+        "traceback": [],
+        "ename": type(err).__name__,
+        "evalue": str(err),
+        'status': "error",
+        'execution_count': execution_count,
+    }
@@ -1,18 +1,15 @@
+import os
 import sys
 import re
-import urllib
-import pandas as pd
-from textwrap import dedent
-from bs4 import BeautifulSoup as bs
-from argparse import ArgumentParser, SUPPRESS
-from pkg_resources import resource_filename
 from .helpers import *
 from .config import get_config
 
 import pystata
 import sfi
 import random
-import numpy as np
+
+# Heavy modules such as bs4, pandas and urllib.request are imported by the
+# magics that need them to keep kernel startup fast.
 
 def print_kernel(msg, kernel):
     msg = re.sub(r'$', r'\r\n', msg, flags=re.MULTILINE)
@@ -22,7 +19,7 @@ def print_kernel(msg, kernel):
 
 class StataMagics():
     html_base = "https://www.stata.com"
-    html_help = urllib.parse.urljoin(html_base, "help.cgi?{}")
+    html_help = html_base + "/help.cgi?{}"
 
     magic_regex = re.compile(
         r'\A(%|\*%)(?P<magic>.+?)(?P<code>\s+(.|\s)+?)?\Z', flags=re.DOTALL + re.MULTILINE)
@@ -36,11 +33,20 @@ class StataMagics():
         'browse': '{} [-h] [N] [varlist] [if] [in]',
         'help': '{} [-h] command_or_topic_name',
         'quietly': '',
-        'noecho': ''
+        'noecho': '',
+        'cache': '{} [-h] [--clear]',
+        'import': '{} [-h] filename [--frame name] [--clear] [--chunksize #] [--types name=type[,...]] [--compress] [--compare]',
+        'memory': '{} [-h]',
+        'python': '%{} [-h]',
+        'results': '{} [-h] [e] [r] [--auto | --noauto]',
+        'parallel': '{} [-h] N name=exp [name=exp ...] [--frame name] [--seed #] [--do filename]',
     }
+
+    # Created on first use of *%cache
+    result_cache = None
     
-    csshelp_default = resource_filename(
-        'pystata-kernel', 'css/_StataKernelHelpDefault.css')
+    csshelp_default = os.path.join(
+        os.path.dirname(__file__), 'css', '_StataKernelHelpDefault.css')
 
     def magic(self, code, kernel):
         match = self.magic_regex.match(code.strip())
@@ -49,11 +55,12 @@ class StataMagics():
             for k in v:
                 v[k] = v[k] if isinstance(v[k],str) else ''                
 
-            name = v['magic'].strip()
+            # Cell magics such as %%python are prefixed with an extra %
+            name = v['magic'].strip().lstrip('%')
             code = v['code'].strip()
 
             if name in self.available_magics:
-                if code.find('-h') >= 0:
+                if '-h' in code.split('\n', 1)[0].split():
                     print_kernel(self.available_magics[name].format(name), kernel)
                     code = ''
                 else:
@@ -108,13 +115,20 @@ class StataMagics():
             obs_range = range(0,min(count(),N_max))
 
         # Missing value display format
-        missingval = env['missing'] if env['missing'] != 'pandas' else np.NaN
+        missingval = env['missing'] if env['missing'] != 'pandas' else float('nan')
         
         try:
             df = better_pdataframe_from_data(obs=obs_range,
                                                     var=vars,
                                                     selectvar=sel_var.varname,
-                                                    missingval=missingval)
+                                                    missingval=missingval,
+                                                    budget=float(env['memory_budget']) * 1024**2,
+                                                    on_budget=env['memory_action'])
+            if df is not None and not hasattr(df, 'to_html'):
+                # Chunked transfer: only the first chunk fits the budget
+                df = next(df)
+                msg = "Showing the first {0} observations that fit memory_budget."
+                print_kernel(msg.format(len(df)), kernel)
             if vars == None and sel_var.varname != None:
                 df = df.drop([sel_var.varname],axis=1)
                 
@@ -140,6 +154,10 @@ class StataMagics():
         """
         Show help file from stata.com.
         """
+        import urllib.request
+        import urllib.parse
+        import urllib.error
+        from bs4 import BeautifulSoup as bs
 
         try:
             reply = urllib.request.urlopen(self.html_help.format(code))
@@ -203,5 +221,388 @@ class StataMagics():
             msg = "Failed to fetch HTML help.\r\n{0}"
             print_kernel(msg.format(e), kernel)
 
-        return ''        
+        return ''
+
+    def magic_cache(self,code,kernel):
+        """
+        Replay the output and results of a cell whose code and data
+        are unchanged since it was last run.
+        """
+        from IPython.utils.capture import capture_output
+        from IPython.display import publish_display_data
+        from .cache import ResultCache
+
+        env = kernel.env
+        if self.result_cache is None:
+            self.result_cache = ResultCache(env['cache_dir'],
+                                            int(float(env['cache_size']) * 1024**2))
+        cache = self.result_cache
+
+        if code == '--clear':
+            print_kernel("Removed {0} cached cell(s).".format(cache.clear()), kernel)
+            return ''
+        if code == '':
+            return ''
+
+        key = cache.key(clean_code(code), data_signature())
+        path = cache.lookup(key)
+        if path is not None:
+            try:
+                output = cache.read_output(path)
+                returned = cache.read_returned(path)
+            except Exception as e:
+                msg = "Failed to read cached results, running cell instead.\r\n{0}"
+                print_kernel(msg.format(e), kernel)
+                cache.discard(key)
+            else:
+                try:
+                    self._restore_cache_state(path, cache, returned, kernel)
+                except Exception as e:
+                    # The data may already be the cell's output, so running
+                    # the cell now could apply it twice
+                    cache.discard(key)
+                    msg = ("Failed to restore cached results; the data and results in memory "
+                           "may be partly restored. Reload your data before running the cell.\r\n{0}")
+                    print_kernel(msg.format(e), kernel)
+                    return ''
+                sys.stdout.write(output['stdout'])
+                sys.stdout.flush()
+                for data, metadata in output['outputs']:
+                    publish_display_data(data, metadata)
+                return ''
+
+        try:
+            with capture_output() as captured:
+                kernel.run_stata(code)
+        except Exception:
+            captured.show()
+            raise
+        captured.show()
+
+        try:
+            path = cache.create(key)
+            self._store_cache_state(path, cache)
+            cache.write_output(path, captured.stdout,
+                               [(o.data, o.metadata) for o in captured.outputs])
+            cache.evict()
+        except Exception as e:
+            cache.discard(key)
+            msg = "Failed to cache results.\r\n{0}"
+            print_kernel(msg.format(e), kernel)
+
+        return ''
+
+    def _store_cache_state(self, path, cache):
+        """
+        Save r(), e() and the data in memory into a cache entry.
+        """
+        cache.write_returned(path, get_returned('r'))
+
+        cmd = ["_return hold __pk_hold"]
+        if sfi.Macro.getGlobal('e(cmd)'):
+            cmd.append('estimates save "{0}", replace'.format(path / cache.estimates_file))
+        cmd.append("_return restore __pk_hold")
+        pystata.stata.run("\n".join(cmd), quietly=True)
+
+        if sfi.Data.getVarCount() > 0:
+            save_data_copy(path / cache.data_file)
+
+    def _restore_cache_state(self, path, cache, returned, kernel):
+        """
+        Load the data and e() saved in a cache entry, and post the r()
+        results read from it.
+        """
+        data_file = path / cache.data_file
+        if data_file.is_file():
+            if not load_data_copy(data_file):
+                msg = ("Warning: the dataset's filename now refers to the cache. "
+                       "Specify a filename when saving.")
+                print_kernel(msg, kernel)
+        else:
+            pystata.stata.run('drop _all', quietly=True)
+
+        estimates_file = path / cache.estimates_file
+        if estimates_file.is_file():
+            pystata.stata.run('estimates use "{0}"'.format(estimates_file), quietly=True)
+        else:
+            pystata.stata.run('ereturn clear', quietly=True)
+
+        post_returned(returned)
+
+    def magic_parallel(self,code,kernel):
+        """
+        Run the iterations of a forvalues loop in N worker processes and
+        collect the posted expressions into a frame.
+        """
+        import shlex
+        import shutil
+        from .parallel import parse_loop, split_values, make_workdir, write_jobs, run_workers
+        from .utils import cpu_limit
+
+        env = kernel.env
+        args, _, loop = code.partition('\n')
+        args = shlex.split(args)
+        frame = 'parallel'
+        seed = random.randrange(1, 2**31 - 1)
+        setup = None
+        try:
+            for opt in ('--frame', '--seed', '--do'):
+                if opt in args:
+                    i = args.index(opt)
+                    value = args[i + 1]
+                    del args[i:i + 2]
+                    if opt == '--frame':
+                        frame = value
+                    elif opt == '--seed':
+                        seed = int(value)
+                    else:
+                        setup = value
+            n = int(args[0])
+            exps = args[1:]
+            if n < 1 or not exps or any('=' not in e for e in exps):
+                raise ValueError
+            var, values, body = parse_loop(loop)
+        except (ValueError, IndexError) as e:
+            msg = "Invalid syntax for %parallel: {0}\r\n{1}"
+            print_kernel(msg.format(e, self.available_magics['parallel'].format('parallel')), kernel)
+            return ''
+
+        workdir = make_workdir()
+        try:
+            # Workers all read the same copy of the data, saved once to
+            # memory-backed storage where available
+            data_file = None
+            if sfi.Data.getVarCount() > 0:
+                data_file = os.path.join(workdir, 'data.dta')
+                try:
+                    save_data_copy(data_file)
+                except SystemError:
+                    # Memory-backed storage may be too small, e.g. the
+                    # 64 MB /dev/shm of a Docker container
+                    shutil.rmtree(workdir, ignore_errors=True)
+                    workdir = make_workdir(shared=False)
+                    data_file = os.path.join(workdir, 'data.dta')
+                    save_data_copy(data_file)
+
+            state = get_session_state()
+            if setup is not None:
+                setup = os.path.join(state['pwd'], os.path.expanduser(setup))
+
+            chunks = split_values(values, n)
+            processors = max(1, cpu_limit() // len(chunks))
+            jobs = write_jobs(workdir, var, chunks, body, exps, data_file, seed, state, setup,
+                              processors)
+
+            def _progress(done, total):
+                print_kernel("Completed {0}/{1} iterations".format(done, total), kernel)
+
+            edition = env['parallel_edition'] or env['edition']
+            print_kernel("Running {0} iterations in {1} workers".format(
+                len(values), len(chunks)), kernel)
+            try:
+                results = run_workers(jobs, env['stata_dir'], edition, _progress)
+            except RuntimeError as e:
+                print_kernel("Worker failed.\r\n{0}".format(e), kernel)
+                return ''
+
+            cmd = ["capture frame drop {0}".format(frame),
+                   "frame create {0}".format(frame),
+                   'frame {0}: use "{1}", clear'.format(frame, results[0])]
+            for r in results[1:]:
+                cmd.append('frame {0}: append using "{1}"'.format(frame, r))
+            pystata.stata.run("\n".join(cmd), quietly=True)
+            print_kernel("Results stored in frame {0}.".format(frame), kernel)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
 
+        return ''
+
+    def magic_memory(self,code,kernel):
+        """
+        Report memory used by Stata datasets, Python objects and the kernel process.
+        """
+        from types import ModuleType, FunctionType
+        from .utils import process_rss, format_bytes
+
+        lines = ["Stata frames:"]
+        for i in range(sfi.Frame.getFrameCount()):
+            name = sfi.Frame.getFrameAt(i)
+            fr = sfi.Frame.connect(name)
+            lines.append("  {0}: {1:,} obs x {2:,} vars, {3}".format(
+                name, fr.getObsTotal(), fr.getVarCount(), format_bytes(dataset_size(fr))))
+
+        sizes = []
+        hidden = kernel.shell.user_ns_hidden
+        for name, obj in kernel.shell.user_ns.items():
+            if name.startswith('_') or name in hidden:
+                continue
+            if isinstance(obj, (ModuleType, FunctionType, type)):
+                continue
+            if hasattr(obj, 'memory_usage'):
+                size = obj.memory_usage(deep=True)
+                size = size.sum() if hasattr(size, 'sum') else size
+            elif hasattr(obj, 'nbytes'):
+                size = obj.nbytes
+            else:
+                size = sys.getsizeof(obj)
+            sizes.append((int(size), name, type(obj).__name__))
+        sizes.sort(reverse=True)
+        lines.append("Python objects:")
+        for size, name, typename in sizes[:10]:
+            lines.append("  {0} ({1}): {2}".format(name, typename, format_bytes(size)))
+        if not sizes:
+            lines.append("  (none)")
+
+        rss, is_peak = process_rss()
+        if rss is not None:
+            label = "Peak process RSS" if is_peak else "Process RSS"
+            lines.append("{0}: {1}".format(label, format_bytes(rss)))
+
+        budget = float(kernel.env['memory_budget'])
+        if budget > 0:
+            lines.append("Transfer budget: {0} ({1})".format(
+                format_bytes(budget * 1024**2), kernel.env['memory_action']))
+        else:
+            lines.append("Transfer budget: none")
+
+        print_kernel("\n".join(lines), kernel)
+        return ''
+
+    def magic_python(self,code,kernel):
+        """
+        Run the cell as Python code in the kernel's IPython namespace.
+        """
+        kernel.python_result = kernel.shell.run_cell(code, store_history=False)
+        return ''
+
+    def magic_results(self,code,kernel):
+        """
+        Display e() and r() results, or switch automatic capture of
+        results after each estimation on and off.
+        """
+        from .results import collect_results, results_to_json
+
+        args = code.split()
+        if set(args) - {'e', 'r', '--auto', '--noauto'} or {'--auto', '--noauto'} <= set(args):
+            msg = "Invalid syntax for %results.\r\n{0}"
+            print_kernel(msg.format(self.available_magics['results'].format('results')), kernel)
+            return ''
+        if '--auto' in args or '--noauto' in args:
+            kernel.env['results_auto'] = 'True' if '--auto' in args else 'False'
+            msg = "Automatic capture of estimation results is {0}."
+            print_kernel(msg.format('on' if '--auto' in args else 'off'), kernel)
+            return ''
+
+        kinds = tuple(k for k in ('e', 'r') if k in args) or ('e', 'r')
+        collected = collect_results(kinds)
+
+        lines = []
+        for kind, results in collected.items():
+            for name, value in results['scalars'].items():
+                lines.append("{0}({1}) = {2}".format(kind, name, value))
+            for name, value in results['macros'].items():
+                lines.append("{0}({1}) : {2}".format(kind, name, value))
+            for name, arr in results['matrices'].items():
+                lines.append("{0}({1}) : {2} x {3} matrix".format(kind, name, *arr.shape))
+
+        content = {
+                'data': {
+                    'text/plain': "\n".join(lines),
+                    'application/json': results_to_json(collected)},
+                'metadata': {}}
+        kernel.send_response(kernel.iopub_socket, 'display_data', content)
+        return ''
+
+    def magic_import(self,code,kernel):
+        """
+        Import a CSV, Parquet or Arrow file in chunks using pyarrow.
+        """
+        import time
+        import shlex
+
+        args = shlex.split(code)
+        frame = None
+        chunksize = 100000
+        types = {}
+        try:
+            for opt in ('--frame', '--chunksize', '--types'):
+                if opt in args:
+                    i = args.index(opt)
+                    value = args[i + 1]
+                    del args[i:i + 2]
+                    if opt == '--frame':
+                        frame = value
+                    elif opt == '--chunksize':
+                        chunksize = int(value)
+                    else:
+                        types = dict(t.split('=', 1) for t in value.split(','))
+            flags = {a for a in args if a.startswith('--')}
+            path = [a for a in args if not a.startswith('--')]
+            if len(path) != 1 or chunksize < 1 or flags - {'--clear', '--compress', '--compare'}:
+                raise ValueError
+            path = os.path.expanduser(path[0])
+        except (ValueError, IndexError):
+            msg = "Invalid syntax for %import.\r\n{0}"
+            print_kernel(msg.format(self.available_magics['import'].format('import')), kernel)
+            return ''
+
+        try:
+            import pyarrow
+        except ImportError:
+            print_kernel("The %import magic requires pyarrow.", kernel)
+            return ''
+        from .importer import import_file, file_format
+        try:
+            types = {k.strip(): pyarrow.type_for_alias(v.strip()) for k, v in types.items()}
+        except ValueError as e:
+            print_kernel("Invalid column type.\r\n{0}".format(e), kernel)
+            return ''
+
+        if not os.path.isfile(path):
+            print_kernel("File {0} not found.".format(path), kernel)
+            return ''
+
+        # Like Stata, refuse to overwrite data unless told to
+        frames = [sfi.Frame.getFrameAt(i) for i in range(sfi.Frame.getFrameCount())]
+        if frame is not None and frame not in frames:
+            pystata.stata.run("frame create {0}".format(frame), quietly=True)
+        else:
+            hdl = sfi.Data if frame is None else sfi.Frame.connect(frame)
+            if (hdl.getVarCount() > 0 or hdl.getObsTotal() > 0) and '--clear' not in flags:
+                print_kernel("no; data in memory would be lost. Specify --clear.", kernel)
+                return ''
+            prefix = '' if frame is None else "frame {0}: ".format(frame)
+            pystata.stata.run(prefix + "clear", quietly=True)
+
+        start = time.perf_counter()
+        try:
+            nobs, nvar, skipped, as_string = import_file(path, frame, chunksize, types)
+        except (pyarrow.ArrowException, SystemError) as e:
+            print_kernel("Failed to import {0}.\r\n{1}".format(path, e), kernel)
+            return ''
+        if '--compress' in flags:
+            prefix = '' if frame is None else "frame {0}: ".format(frame)
+            pystata.stata.run(prefix + "compress", quietly=True)
+        elapsed = time.perf_counter() - start
+
+        msg = "({0:,} vars, {1:,} obs) imported in {2:.2f}s, {3:,.0f} obs/s"
+        print_kernel(msg.format(nvar, nobs, elapsed, nobs / max(elapsed, 1e-9)), kernel)
+        if skipped:
+            print_kernel("Skipped columns of unsupported type: {0}".format(" ".join(skipped)), kernel)
+        if as_string:
+            msg = "Columns read as strings after a type conversion error: {0}"
+            print_kernel(msg.format(" ".join(as_string)), kernel)
+
+        if '--compare' in flags and file_format(path) == 'csv':
+            start = time.perf_counter()
+            pystata.stata.run("""capture frame drop __pk_compare
+                                 frame create __pk_compare
+                                 capture frame __pk_compare: import delimited using `"{0}"', clear
+                                 local __pk_rc = _rc
+                                 frame drop __pk_compare
+                                 error `__pk_rc'""".format(path), quietly=True)
+            elapsed = time.perf_counter() - start
+            msg = "import delimited: {0:.2f}s, {1:,.0f} obs/s"
+            print_kernel(msg.format(elapsed, nobs / max(elapsed, 1e-9)), kernel)
+
+        return ''
@@ -0,0 +1,223 @@
+# Worker processes for the *%parallel magic.
+# The driver functions run inside the kernel and do not require Stata;
+# running this module starts a worker, which launches its own Stata instance.
+
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+
+# Regex for the header of a forvalues loop at the start of the cell
+loop_regex = re.compile(
+    r'\A\s*forv(?:a(?:l(?:u(?:e(?:s)?)?)?)?)?\s+(?P<var>\w+)\s*=\s*(?P<range>[^{]+?)\s*\{')
+# Regex for the range of a forvalues loop: a/b or a(d)b
+range_regex = re.compile(
+    r'\A(?P<start>-?\d+)\s*(?:/\s*(?P<end>-?\d+)|\(\s*(?P<step>-?\d+)\s*\)\s*(?P<stop>-?\d+))\Z')
+
+progress_prefix = 'PYSTATA-KERNEL-PROGRESS '
+
+def parse_loop(code):
+    """
+    Split a forvalues loop into loop variable, values and body
+    """
+    match = loop_regex.match(code)
+    if not match:
+        raise ValueError("*%parallel requires a single forvalues loop.")
+    # Find the brace closing the loop
+    depth = 1
+    for end in range(match.end(), len(code)):
+        if code[end] == '{':
+            depth += 1
+        elif code[end] == '}':
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        raise ValueError("Unbalanced braces in loop.")
+    if code[end + 1:].strip():
+        raise ValueError("*%parallel requires a single forvalues loop.")
+    rmatch = range_regex.match(match.group('range').strip())
+    if not rmatch:
+        raise ValueError("Loop range must be of the form a/b or a(d)b.")
+    start = int(rmatch.group('start'))
+    if rmatch.group('end') is not None:
+        values = list(range(start, int(rmatch.group('end')) + 1))
+    else:
+        step = int(rmatch.group('step'))
+        if step == 0:
+            raise ValueError("Loop step cannot be zero.")
+        stop = int(rmatch.group('stop'))
+        values = list(range(start, stop + (1 if step > 0 else -1), step))
+    return match.group('var'), values, code[match.end():end].strip()
+
+def split_values(values, n):
+    """
+    Split loop values into at most n contiguous chunks of similar size
+    """
+    n = max(1, min(n, len(values)))
+    size, extra = divmod(len(values), n)
+    chunks = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(values[start:end])
+        start = end
+    return chunks
+
+def shared_dir():
+    """
+    Directory for files shared with workers, memory-backed where available
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+def run_workers(jobs, stata_dir, edition, progress=None, interval=1.0):
+    """
+    Run one worker per job file, calling progress(done, total) while they run.
+    Returns the list of result files, raising RuntimeError if a worker fails.
+    """
+    total = 0
+    for job in jobs:
+        with open(job) as f:
+            total += len(json.load(f)['values'])
+
+    done = [0] * len(jobs)
+    procs = []
+    threads = []
+
+    def _read_progress(i, proc):
+        for line in proc.stdout:
+            if line.startswith(progress_prefix):
+                done[i] = int(line[len(progress_prefix):])
+
+    # stderr goes to a file, so that a worker writing a lot to it cannot
+    # block on a full pipe
+    errfiles = [os.path.splitext(job)[0] + '.err' for job in jobs]
+    for i, job in enumerate(jobs):
+        with open(errfiles[i], 'w') as err:
+            proc = subprocess.Popen(
+                [sys.executable, '-m', __package__ + '.parallel',
+                 stata_dir, edition, job],
+                stdout=subprocess.PIPE, stderr=err, text=True)
+        thread = threading.Thread(target=_read_progress, args=(i, proc), daemon=True)
+        thread.start()
+        procs.append(proc)
+        threads.append(thread)
+
+    try:
+        last = -1
+        while any(p.poll() is None for p in procs):
+            time.sleep(interval)
+            if progress is not None and sum(done) != last:
+                last = sum(done)
+                progress(last, total)
+    except BaseException:
+        for p in procs:
+            p.kill()
+        raise
+
+    for t in threads:
+        t.join()
+    errors = []
+    for p, errfile in zip(procs, errfiles):
+        if p.returncode != 0:
+            with open(errfile) as f:
+                errors.append(f.read().strip())
+    if errors:
+        raise RuntimeError("\n".join(errors))
+    if progress is not None:
+        progress(total, total)
+
+    results = []
+    for job in jobs:
+        with open(job) as f:
+            results.append(json.load(f)['output'])
+    return results
+
+def write_jobs(workdir, var, chunks, body, exps, data_file, seed, state, setup=None,
+               processors=None):
+    """
+    Write one job file per chunk of loop values. state holds the globals,
+    scalars and matrices from get_session_state(), setup is an optional
+    do-file run by each worker after loading the data and before the loop,
+    and processors is the Stata/MP processors setting of each worker.
+    """
+    jobs = []
+    for i, values in enumerate(chunks):
+        job = os.path.join(workdir, f'job{i}.json')
+        with open(job, 'w') as f:
+            json.dump({'var': var,
+                       'values': values,
+                       'body': body,
+                       'exps': exps,
+                       'data': data_file,
+                       'seed': seed,
+                       'state': state,
+                       'setup': setup,
+                       'processors': processors,
+                       'stream': i + 1,
+                       'output': os.path.join(workdir, f'results{i}.dta')}, f)
+        jobs.append(job)
+    return jobs
+
+def make_workdir(shared=True):
+    """
+    Temporary directory for job files, in memory-backed storage if shared
+    """
+    return tempfile.mkdtemp(prefix='pystata-kernel-', dir=shared_dir() if shared else None)
+
+def worker(stata_dir, edition, job_file):
+    """
+    Run the loop values of a job in a new Stata instance
+    """
+    with open(job_file) as f:
+        job = json.load(f)
+
+    sys.path.append(os.path.join(stata_dir, 'utilities'))
+    import pystata
+    try:
+        pystata.config.init(edition, splash=False)
+    except TypeError:
+        # Splash message control is a new feature of pystata-0.1.1
+        pystata.config.init(edition)
+    from pystata.stata import run
+    from .helpers import set_session_state
+
+    var = job['var']
+    names = [e.split('=', 1)[0].strip() for e in job['exps']]
+    exps = [e.split('=', 1)[1].strip() for e in job['exps']]
+
+    set_session_state(job['state'])
+    setup = []
+    if job['data']:
+        setup.append(f'use "{job["data"]}", clear')
+    # Share the kernel's CPUs between workers; fails harmlessly outside Stata/MP
+    if job['processors']:
+        setup.append(f"capture set processors {job['processors']}")
+    setup += ["set rng mt64s",
+              f"set rngstream {job['stream']}",
+              f"set seed {job['seed']}"]
+    # Run after loading the data, so that the do-file can also prepare it
+    if job['setup']:
+        setup.append(f'do "{job["setup"]}"')
+    setup.append(f"frame create __pk_results long {var} double({' '.join(names)})")
+    run("\n".join(setup), quietly=True)
+
+    post = f"frame post __pk_results (`{var}')" + ''.join(f" ({e})" for e in exps)
+    for i, value in enumerate(job['values']):
+        run(f"local {var} = {value}\n{job['body']}\n{post}", quietly=True)
+        print(f"{progress_prefix}{i + 1}", flush=True)
+
+    run(f'frame __pk_results: save "{job["output"]}", replace', quietly=True)
+
+if __name__ == '__main__':
+    try:
+        worker(*sys.argv[1:4])
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,79 @@
+# Structured e() and r() results for the *%results magic and Python cells.
+# numpy is imported when results are collected.
+
+import sfi
+from collections import deque
+from .helpers import get_all_returned, estimation_fingerprint
+
+def _nan_missing(value):
+    return float('nan') if sfi.Missing.isMissing(value) else value
+
+def collect_results(kinds=('e', 'r')):
+    """
+    Collect results in one pass. Returns a dict keyed by kind, each holding
+    'scalars', 'macros', 'matrices' as NumPy arrays, and the row and column
+    names of each matrix under 'rownames' and 'colnames'. Missing values
+    are returned as NaN.
+    """
+    import numpy as np
+
+    missing = sfi.Missing.getValue()
+    collected = {}
+    for kind, returned in get_all_returned(kinds).items():
+        results = {'scalars': {k: _nan_missing(v) for k, v in returned['scalars'].items()},
+                   'macros': returned['macros'],
+                   'matrices': {},
+                   'rownames': {},
+                   'colnames': {}}
+        for name, (values, rownames, colnames) in returned['matrices'].items():
+            arr = np.array(values, dtype=float).reshape(len(rownames), len(colnames))
+            arr[arr >= missing] = np.nan
+            results['matrices'][name] = arr
+            results['rownames'][name] = rownames
+            results['colnames'][name] = colnames
+        collected[kind] = results
+    return collected
+
+def results_to_json(collected):
+    """
+    JSON-serializable copy of collected results, with NaN as None
+    """
+    import numpy as np
+
+    def _clean(value):
+        if isinstance(value, float) and value != value:
+            return None
+        return value
+
+    out = {}
+    for kind, results in collected.items():
+        out[kind] = {'scalars': {k: _clean(v) for k, v in results['scalars'].items()},
+                     'macros': results['macros'],
+                     'matrices': {}}
+        for name, arr in results['matrices'].items():
+            out[kind]['matrices'][name] = {
+                'rownames': results['rownames'][name],
+                'colnames': results['colnames'][name],
+                'values': [[_clean(float(v)) for v in row] for row in np.asarray(arr)]}
+    return out
+
+class ResultsHistory(deque):
+    """
+    Bounded history of estimation results, most recent last
+    """
+
+    def __init__(self, maxlen):
+        super().__init__(maxlen=maxlen)
+        self.fingerprint = None
+
+    def update(self):
+        """
+        Record e() and r() if new estimation results have been posted.
+        Returns True if results were recorded.
+        """
+        fingerprint = estimation_fingerprint()
+        if fingerprint is None or fingerprint == self.fingerprint:
+            return False
+        self.fingerprint = fingerprint
+        self.append(collect_results())
+        return True
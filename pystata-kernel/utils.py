@@ -8,6 +8,10 @@ import platform
 from shutil import which
 from pathlib import Path
 
+# Where the cgroups of the current process are listed and mounted
+proc_cgroup = '/proc/self/cgroup'
+cgroup_root = '/sys/fs/cgroup'
+
 def find_dir_edition():
     stata_path = find_path()
     stata_dir = str(os.path.dirname(stata_path))
@@ -70,3 +74,129 @@ def mac_find_path():
         return str(path)
 
 
+
+def process_rss():
+    """
+    Resident set size of the current process in bytes.
+
+    Returns:
+        (tuple): (size, is_peak). Falls back to peak usage where the
+        current size cannot be read. Size is None if neither is available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return (int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'), False)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return (psutil.Process().memory_info().rss, False)
+    except ImportError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes except on macOS
+        return (peak if platform.system() == 'Darwin' else peak * 1024, True)
+    except ImportError:
+        return (None, False)
+
+def format_bytes(size):
+    """
+    Human-readable size, e.g. 1.5 MB
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def _cgroup_dirs(controller):
+    """
+    cgroup directories of the current process for a controller, innermost
+    first, so that limits set on parent groups are also found.
+    Covers both cgroup v2 and v1 hierarchies.
+    """
+    try:
+        with open(proc_cgroup) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    dirs = []
+    for line in lines:
+        try:
+            _, controllers, path = line.split(':', 2)
+        except ValueError:
+            continue
+        if controllers == '':
+            base = cgroup_root
+        elif controller in controllers.split(','):
+            base = os.path.join(cgroup_root, controllers)
+            if not os.path.isdir(base):
+                base = os.path.join(cgroup_root, controller)
+        else:
+            continue
+        # Inside a container the path may refer to the host's hierarchy,
+        # in which case only the root directory exists.
+        path = path.strip('/')
+        while True:
+            d = os.path.normpath(os.path.join(base, path))
+            if os.path.isdir(d) and d not in dirs:
+                dirs.append(d)
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return dirs
+
+def _read_cgroup_file(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+def cpu_limit():
+    """
+    Number of CPUs this process may use, taking into account the affinity
+    mask and any cgroup CPU quota. 
+
+    Returns:
+        (int): Number of CPUs, rounded up for fractional quotas.
+    """
+    try:
+        limit = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on Windows and macOS
+        limit = os.cpu_count() or 1
+
+    for d in _cgroup_dirs('cpu'):
+        # cgroup v2: "quota period", quota is "max" if unlimited
+        value = _read_cgroup_file(os.path.join(d, 'cpu.max'))
+        if value and value[0] != 'max':
+            quota, period = int(value[0]), int(value[1])
+        else:
+            # cgroup v1: quota is -1 if unlimited
+            quota = _read_cgroup_file(os.path.join(d, 'cpu.cfs_quota_us'))
+            period = _read_cgroup_file(os.path.join(d, 'cpu.cfs_period_us'))
+            if not quota or not period or int(quota[0]) <= 0:
+                continue
+            quota, period = int(quota[0]), int(period[0])
+        limit = min(limit, max(1, -(-quota // period)))
+    return limit
+
+def memory_limit():
+    """
+    cgroup memory limit of this process in bytes.
+
+    Returns:
+        (int): Limit in bytes. None if there is no limit.
+    """
+    limit = None
+    for d in _cgroup_dirs('memory'):
+        value = (_read_cgroup_file(os.path.join(d, 'memory.max'))
+                 or _read_cgroup_file(os.path.join(d, 'memory.limit_in_bytes')))
+        # cgroup v1 reports no limit as a very large number
+        if value and value[0] != 'max' and int(value[0]) < 2**60:
+            limit = int(value[0]) if limit is None else min(limit, int(value[0]))
+    return limit
@@ -17,11 +17,13 @@ setup(
         'jupyter-client', 
         'ipython', 
         'ipykernel',
-        'packaging', 
         'pandas', 
         'numpy',
         'beautifulsoup4'
     ],
+    extras_require={
+        'import': ['pyarrow'],
+    },
     include_package_data=True,
     classifiers=[
         'Intended Audience :: Developers',
@@ -0,0 +1,16 @@
+import os
+from importlib.util import spec_from_file_location, module_from_spec
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_module(name):
+    """
+    Load a module of the kernel package from its file.
+    The package directory is not a valid Python identifier, and importing
+    the package imports the kernel class, which requires ipykernel. Modules
+    loaded this way cannot use relative imports at the top level.
+    """
+    spec = spec_from_file_location(name, os.path.join(root, 'pystata-kernel', name + '.py'))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+from modules import load_module
+
+cache = load_module('cache')
+
+class Test_ResultCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = cache.ResultCache(tmp.name, size_limit=250)
+
+    def add(self, key, size, mtime):
+        # Complete entry of about size bytes, last used at mtime
+        path = self.cache.create(key)
+        with open(path / 'data.dta', 'wb') as f:
+            f.write(b'\0' * size)
+        self.cache.write_output(path, '', [])
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_key(self):
+        key = self.cache.key('regress y x', 'sig')
+        self.assertEqual(key, self.cache.key('regress y x', 'sig'))
+        self.assertNotEqual(key, self.cache.key('regress y x', 'other'))
+        self.assertNotEqual(key, self.cache.key('regress y', 'x sig'))
+
+    def test_lookup(self):
+        key = self.cache.key('sum', 'sig')
+        self.assertIsNone(self.cache.lookup(key))
+        path = self.cache.create(key)
+        # Incomplete until the output is written
+        self.assertIsNone(self.cache.lookup(key))
+        self.cache.write_output(path, 'out', [({'text/plain': 'x'}, {})])
+        os.utime(path, (0, 0))
+        self.assertEqual(self.cache.lookup(key), path)
+        self.assertGreater(path.stat().st_mtime, 0)
+        self.assertEqual(self.cache.read_output(path),
+                         {'stdout': 'out', 'outputs': [({'text/plain': 'x'}, {})]})
+
+    def test_returned(self):
+        path = self.cache.create('a')
+        self.cache.write_returned(path, {'r(N)': 5.0})
+        self.assertEqual(self.cache.read_returned(path), {'r(N)': 5.0})
+
+    def test_discard(self):
+        self.add('a', 10, 1)
+        self.cache.discard('a')
+        self.assertIsNone(self.cache.lookup('a'))
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_evict(self):
+        self.add('old', 100, 1)
+        self.add('mid', 100, 2)
+        self.add('new', 100, 3)
+        self.assertEqual(self.cache.evict(), 2)
+        self.assertEqual([e[0].name for e in self.cache.entries()], ['new'])
+
+    def test_evict_within_limit(self):
+        self.add('a', 10, 1)
+        self.add('b', 10, 2)
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_clear(self):
+        self.assertEqual(self.cache.clear(), 0)
+        self.add('a', 10, 1)
+        self.add('b', 10, 2)
+        self.assertEqual(self.cache.clear(), 2)
+        self.assertEqual(self.cache.entries(), [])
@@ -0,0 +1,76 @@
+import time
+import unittest
+
+from modules import load_module
+
+explorer = load_module('explorer')
+diff = explorer.diff
+
+def snapshot(obs, *vars):
+    return {'obs': obs, 'vars': [tuple(v) for v in vars]}
+
+class Test_diff(unittest.TestCase):
+
+    def test_unchanged(self):
+        s = snapshot(5, ('a', 'float', ''), ('b', 'str5', 'B'))
+        self.assertEqual(diff(s, s), {})
+
+    def test_obs(self):
+        old = snapshot(5, ('a', 'float', ''))
+        new = snapshot(7, ('a', 'float', ''))
+        self.assertEqual(diff(old, new), {'obs': 7})
+
+    def test_added_dropped(self):
+        old = snapshot(5, ('a', 'float', ''), ('b', 'byte', ''), ('c', 'int', ''))
+        new = snapshot(5, ('a', 'float', ''), ('c', 'int', ''), ('d', 'double', ''))
+        self.assertEqual(diff(old, new), {
+            'added': [{'name': 'd', 'type': 'double', 'label': ''}],
+            'dropped': ['b']})
+
+    def test_rename(self):
+        old = snapshot(5, ('a', 'float', ''), ('b', 'str5', 'B'), ('c', 'int', ''))
+        new = snapshot(5, ('a', 'float', ''), ('bb', 'str5', 'B'), ('c', 'int', ''))
+        self.assertEqual(diff(old, new), {'renamed': [['b', 'bb']]})
+
+    def test_drop_then_generate_last(self):
+        # drop b followed by gen c of the same type is not a rename
+        old = snapshot(5, ('a', 'float', ''), ('b', 'float', ''))
+        new = snapshot(5, ('a', 'float', ''), ('c', 'float', ''))
+        self.assertEqual(diff(old, new), {
+            'added': [{'name': 'c', 'type': 'float', 'label': ''}],
+            'dropped': ['b']})
+
+    def test_drop_then_generate_several(self):
+        # drop b c followed by gen x and gen y
+        old = snapshot(5, ('a', 'float', ''), ('b', 'float', ''), ('c', 'float', ''))
+        new = snapshot(5, ('a', 'float', ''), ('x', 'float', ''), ('y', 'float', ''))
+        self.assertEqual(diff(old, new), {
+            'added': [{'name': 'x', 'type': 'float', 'label': ''},
+                      {'name': 'y', 'type': 'float', 'label': ''}],
+            'dropped': ['b', 'c']})
+
+    def test_rename_and_generate(self):
+        old = snapshot(5, ('a', 'float', ''), ('b', 'float', ''))
+        new = snapshot(5, ('aa', 'float', ''), ('b', 'float', ''), ('c', 'float', ''))
+        self.assertEqual(diff(old, new), {
+            'added': [{'name': 'c', 'type': 'float', 'label': ''}],
+            'renamed': [['a', 'aa']]})
+
+    def test_changed(self):
+        old = snapshot(5, ('a', 'float', ''), ('b', 'byte', ''))
+        new = snapshot(5, ('a', 'double', 'A'), ('b', 'byte', ''))
+        self.assertEqual(diff(old, new), {
+            'changed': [{'name': 'a', 'type': 'double', 'label': 'A'}]})
+
+    def test_order(self):
+        old = snapshot(5, ('a', 'float', ''), ('b', 'byte', ''), ('c', 'int', ''))
+        new = snapshot(5, ('c', 'int', ''), ('a', 'float', ''), ('b', 'byte', ''))
+        self.assertEqual(diff(old, new), {'order': ['c', 'a', 'b']})
+
+    def test_many_variables(self):
+        empty = snapshot(0)
+        full = snapshot(100, *[(f'v{i}', 'double', '') for i in range(20000)])
+        start = time.perf_counter()
+        self.assertEqual(len(diff(empty, full)['added']), 20000)
+        self.assertEqual(len(diff(full, empty)['dropped']), 20000)
+        self.assertLess(time.perf_counter() - start, 0.5)
@@ -0,0 +1,100 @@
+import os
+import re
+import sys
+import unittest
+import subprocess
+from textwrap import dedent
+from importlib.util import find_spec
+
+# Modules the kernel must not import before a magic needs them
+deferred = ('pandas', 'numpy', 'bs4', 'pkg_resources', 'packaging', 'urllib.request')
+
+# Budgets in milliseconds for every module imported by the kernel, excluding
+# ipykernel and pystata themselves, which are imported before timing starts
+launch_budget = float(os.getenv('PYSTATA_KERNEL_LAUNCH_BUDGET', 100))
+first_cell_budget = float(os.getenv('PYSTATA_KERNEL_FIRST_CELL_BUDGET', 100))
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+importtime_regex = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)')
+marker = 'PYSTATA-KERNEL-SETUP-DONE'
+
+def load(setup, modules, code=''):
+    """
+    Import modules and then run code, after running setup, with -X importtime.
+    Returns the total self time in milliseconds of the modules imported
+    after setup, including third-party ones, and the set of those modules.
+    """
+    script = dedent(f"""
+        import sys, importlib
+        {setup}
+        before = set(sys.modules)
+        print({marker!r}, file=sys.stderr, flush=True)
+        for module in {list(modules)!r}:
+            importlib.import_module(module)
+        {code}
+        print(' '.join(sorted(set(sys.modules) - before)))
+        """)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                          cwd=root, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+
+    # Modules imported by setup are not counted
+    total = 0
+    for line in proc.stderr.split(marker, 1)[1].splitlines():
+        match = importtime_regex.match(line)
+        if match:
+            total += int(match.group(1))
+    return total / 1000, set(proc.stdout.split())
+
+
+class Test_load(unittest.TestCase):
+
+    def test_counts_other_modules(self):
+        # Time spent in third-party modules counts towards the budget
+        time, loaded = load("import json", ['decimal'])
+        self.assertGreater(time, 0)
+        self.assertIn('decimal', loaded)
+        self.assertNotIn('json', loaded)
+
+
+@unittest.skipUnless(find_spec('ipykernel'), 'ipykernel is not installed')
+class Test_kernel_launch(unittest.TestCase):
+
+    def setUp(self):
+        self.time, self.loaded = load("import ipykernel.ipkernel", ['pystata-kernel'])
+
+    def test_deferred_modules(self):
+        for module in deferred:
+            self.assertNotIn(module, self.loaded)
+
+    def test_budget(self):
+        self.assertLess(self.time, launch_budget)
+
+
+@unittest.skipUnless(os.getenv('STATA_DIR'), 'STATA_DIR is not set')
+class Test_first_cell(unittest.TestCase):
+    """
+    Modules loaded by creating the kernel and by its first cell, after Stata
+    itself has started: the variable explorer, magics, data view and results
+    history, and the resource limits applied before the cell runs
+    """
+
+    def setUp(self):
+        utilities = os.path.join(os.getenv('STATA_DIR'), 'utilities')
+        edition = os.getenv('STATA_EDITION', 'be')
+        setup = (f"sys.path.append({utilities!r}); import pystata; "
+                 f"pystata.config.init({edition!r}, splash=False); "
+                 f"importlib.import_module('pystata-kernel')")
+        modules = ['pystata-kernel.explorer', 'pystata-kernel.helpers', 'pystata-kernel.magics',
+                   'pystata-kernel.dataview', 'pystata-kernel.results']
+        env = {'edition': edition, 'processors': 'auto', 'max_memory': 'auto'}
+        code = f"sys.modules['pystata-kernel.helpers'].set_resource_limits({env!r})"
+        self.time, self.loaded = load(setup, modules, code)
+
+    def test_deferred_modules(self):
+        for module in deferred:
+            self.assertNotIn(module, self.loaded)
+
+    def test_budget(self):
+        self.assertLess(self.time, first_cell_budget)
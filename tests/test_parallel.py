@@ -0,0 +1,51 @@
+import unittest
+
+from modules import load_module
+
+parallel = load_module('parallel')
+parse_loop = parallel.parse_loop
+split_values = parallel.split_values
+
+class Test_parse_loop(unittest.TestCase):
+
+    def test_range(self):
+        var, values, body = parse_loop("forvalues i=1/3 {\n di `i'\n}\n")
+        self.assertEqual((var, values, body), ('i', [1, 2, 3], "di `i'"))
+
+    def test_step(self):
+        self.assertEqual(parse_loop("forv rep = 10(-5)0 { di 1 }")[1], [10, 5, 0])
+        self.assertEqual(parse_loop("forval k=1(2)6 { di 1 }")[1], [1, 3, 5])
+
+    def test_nested_braces(self):
+        code = "forvalues i=1/2 {\n if `i' == 1 {\n  di ${x}\n }\n}"
+        self.assertEqual(parse_loop(code)[2], "if `i' == 1 {\n  di ${x}\n }")
+
+    def test_two_loops(self):
+        code = "forvalues i=1/3 {\n di `i'\n}\nforvalues j=1/2 {\n di `j'\n}"
+        with self.assertRaises(ValueError):
+            parse_loop(code)
+
+    def test_trailing_code(self):
+        with self.assertRaises(ValueError):
+            parse_loop("forvalues i=1/3 {\n di `i'\n}\ndi 1")
+
+    def test_invalid(self):
+        for code in ("foreach i of numlist 1/3 { di `i' }",
+                     "forvalues i=1/3 {\n di `i'\n",
+                     "forvalues i=1 2 3 { di `i' }",
+                     "forvalues i=1(0)3 { di `i' }"):
+            with self.assertRaises(ValueError):
+                parse_loop(code)
+
+
+class Test_split_values(unittest.TestCase):
+
+    def test_even(self):
+        self.assertEqual(split_values(list(range(6)), 3), [[0, 1], [2, 3], [4, 5]])
+
+    def test_uneven(self):
+        self.assertEqual(split_values(list(range(7)), 3), [[0, 1, 2], [3, 4], [5, 6]])
+
+    def test_more_workers_than_values(self):
+        self.assertEqual(split_values([1, 2], 4), [[1], [2]])
+        self.assertEqual(split_values([1, 2], 0), [[1, 2]])
@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from modules import load_module
+
+utils = load_module('utils')
+
+class CgroupTestCase(unittest.TestCase):
+    """
+    Fake /proc/self/cgroup and cgroup hierarchy in a temporary directory
+    """
+
+    proc = ''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = os.path.join(tmp.name, 'cgroup')
+        os.mkdir(self.root)
+        proc = os.path.join(tmp.name, 'proc_cgroup')
+        with open(proc, 'w') as f:
+            f.write(self.proc)
+        for name, value in (('proc_cgroup', proc), ('cgroup_root', self.root)):
+            patcher = mock.patch.object(utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(utils.os, 'sched_getaffinity',
+                                    lambda pid: set(range(16)), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, value):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def dir(self, path):
+        return os.path.join(self.root, path) if path else self.root
+
+
+class Test_cgroup_v2(CgroupTestCase):
+
+    proc = '0::/user.slice/job_1/step_0\n'
+
+    def test_dirs(self):
+        self.write('user.slice/job_1/step_0/cpu.max', 'max 100000')
+        self.assertEqual(utils._cgroup_dirs('cpu'),
+                         [self.dir('user.slice/job_1/step_0'), self.dir('user.slice/job_1'),
+                          self.dir('user.slice'), self.dir('')])
+
+    def test_host_path(self):
+        # Inside a container only the root of the hierarchy exists
+        self.assertEqual(utils._cgroup_dirs('memory'), [self.dir('')])
+
+    def test_unlimited(self):
+        self.write('user.slice/job_1/step_0/cpu.max', 'max 100000')
+        self.write('user.slice/job_1/step_0/memory.max', 'max')
+        self.assertEqual(utils.cpu_limit(), 16)
+        self.assertIsNone(utils.memory_limit())
+
+    def test_parent_limit(self):
+        self.write('user.slice/job_1/step_0/cpu.max', 'max 100000')
+        self.write('user.slice/job_1/cpu.max', '250000 100000')
+        self.write('user.slice/job_1/step_0/memory.max', 'max')
+        self.write('user.slice/job_1/memory.max', str(8 * 1024**3))
+        self.write('user.slice/memory.max', str(16 * 1024**3))
+        self.assertEqual(utils.cpu_limit(), 3)
+        self.assertEqual(utils.memory_limit(), 8 * 1024**3)
+
+    def test_affinity(self):
+        self.write('cpu.max', '1600000 100000')
+        with mock.patch.object(utils.os, 'sched_getaffinity', lambda pid: {0, 1}, create=True):
+            self.assertEqual(utils.cpu_limit(), 2)
+
+
+class Test_cgroup_v1(CgroupTestCase):
+
+    proc = ('12:memory:/docker/abc\n'
+            '11:cpu,cpuacct:/docker/abc\n'
+            '1:name=systemd:/docker/abc\n')
+
+    def test_dirs(self):
+        self.write('cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '-1')
+        self.write('memory/docker/abc/memory.limit_in_bytes', '1')
+        self.assertEqual(utils._cgroup_dirs('cpu'),
+                         [self.dir('cpu,cpuacct/docker/abc'), self.dir('cpu,cpuacct/docker'),
+                          self.dir('cpu,cpuacct')])
+        self.assertEqual(utils._cgroup_dirs('memory'),
+                         [self.dir('memory/docker/abc'), self.dir('memory/docker'),
+                          self.dir('memory')])
+
+    def test_controller_link(self):
+        # Some systems only mount the hierarchy under the controller's name
+        self.write('cpu/docker/abc/cpu.cfs_quota_us', '-1')
+        self.assertEqual(utils._cgroup_dirs('cpu')[0], self.dir('cpu/docker/abc'))
+
+    def test_unlimited(self):
+        self.write('cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '-1')
+        self.write('cpu,cpuacct/docker/abc/cpu.cfs_period_us', '100000')
+        self.write('memory/docker/abc/memory.limit_in_bytes', str(2**63 - 4096))
+        self.assertEqual(utils.cpu_limit(), 16)
+        self.assertIsNone(utils.memory_limit())
+
+    def test_limits(self):
+        self.write('cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '150000')
+        self.write('cpu,cpuacct/docker/abc/cpu.cfs_period_us', '100000')
+        self.write('memory/docker/abc/memory.limit_in_bytes', str(4 * 1024**3))
+        self.assertEqual(utils.cpu_limit(), 2)
+        self.assertEqual(utils.memory_limit(), 4 * 1024**3)
+
+
+class Test_no_cgroup(CgroupTestCase):
+
+    def test_missing_proc(self):
+        with mock.patch.object(utils, 'proc_cgroup', os.path.join(self.root, 'missing')):
+            self.assertEqual(utils._cgroup_dirs('cpu'), [])
+            self.assertEqual(utils.cpu_limit(), 16)
+            self.assertIsNone(utils.memory_limit())